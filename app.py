@@ -1,11 +1,22 @@
-from flask import Flask, render_template, send_from_directory, abort, url_for
+from flask import Flask, render_template, send_from_directory, abort, url_for, request, make_response
+from flask_compress import Compress
+from werkzeug.security import safe_join
 import os
 import markdown
 from markdown.extensions.extra import ExtraExtension
+import cmarkgfm
+from cmarkgfm.cmark import Options as CmarkOptions
 import urllib.parse
+import mimetypes
 import re
 import logging
-import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import time
+import threading
+import zlib
+from functools import lru_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -15,101 +26,219 @@ class Config:
     UPLOAD_FOLDER = "static/media"
     MARKDOWN_FOLDER = "static/markdown"
     HISTORY_RETENTION = 7
+    # Seconds a directory listing is reused before re-scanning
+    LISTING_CACHE_TTL = 5.0
+    # Seconds between background rebuilds of the index page listings
+    LISTING_REFRESH_INTERVAL = 5.0
+    # Let the front-end server (Apache mod_xsendfile, lighttpd) send media
+    # bodies: send_from_directory then emits an X-Sendfile header instead
+    # of streaming the file through the WSGI worker. Needs server support.
+    # The file routes must stay out of Flask-Compress: compressing the empty
+    # X-Sendfile body would label the raw file the server sends as gzip.
+    USE_X_SENDFILE = False
+    # nginx: internal location prefixes mapped to UPLOAD_FOLDER / MARKDOWN_FOLDER
+    # (e.g. "/_protected_media/"). When set, the file routes answer with an
+    # X-Accel-Redirect header and nginx sends the body itself.
+    MEDIA_ACCEL_REDIRECT = None
+    ASSETS_ACCEL_REDIRECT = None
+    # Flask-Compress: prefer brotli, fall back to gzip, skip tiny bodies.
+    # Only routes decorated with @compress.compressed() are compressed; file
+    # routes keep send_file's strong ETags and 304s.
+    COMPRESS_REGISTER = False
+    COMPRESS_ALGORITHM = ["br", "gzip"]
+    COMPRESS_MIN_SIZE = 1024
     # Extensions configuration
     MEDIA_EXTENSIONS = [".wav", ".mp4"]
     IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif"]
     MARKDOWN_EXTENSIONS = [".md"]
+    # Markdown parser: "cmark" (cmark-gfm, C) or "python-markdown" for
+    # documents that rely on Extra features such as abbreviations or attr_list
+    MARKDOWN_ENGINE = "cmark"
+    # Worker processes for the python-markdown engine, which holds the GIL
+    # while parsing (cmark releases it). 0 renders in the request thread;
+    # os.cpu_count() lets heavy documents render in parallel on multi-core hosts.
+    MARKDOWN_RENDER_PROCESSES = 0
 
 app = Flask(__name__)
 app.config.from_object(Config)
+# gzip/brotli for rendered HTML pages, negotiated from Accept-Encoding
+compress = Compress(app)
+
+# (directory, extensions) -> (scanned_at, root_mtime_ns, files)
+_LIST_CACHE = {}
 
 def get_files(directory, extensions=None):
     """
     Recursively get files from a directory.    
+    Listings are cached for LISTING_CACHE_TTL seconds, or until the
+    directory's own mtime changes.
     Args:
         directory (str): The directory to search.
         extensions (list): List of allowed file extensions (e.g., ['.md']).        
     Returns:
         list: List of relative file paths.
     """
-    files = []
     # Walk safely
-    if not os.path.exists(directory):
+    try:
+        root_mtime = os.stat(directory).st_mtime_ns
+    except OSError:
         logger.warning(f"Directory not found: {directory}")
-        return files
+        return []
 
-    for root, dirs, filenames in os.walk(directory):
-        # Sort directories and keep only the top N (assumed specifically for history retention)
-        dirs.sort(reverse=True)
-        if app.config["HISTORY_RETENTION"] > 0:
-            dirs[:] = dirs[:app.config["HISTORY_RETENTION"]]
-            
+    key = (directory, tuple(extensions) if extensions else None)
+    now = time.monotonic()
+    cached = _LIST_CACHE.get(key)
+    if cached and now - cached[0] < app.config["LISTING_CACHE_TTL"] and cached[1] == root_mtime:
+        return cached[2]
+
+    files = _scan_files(directory, extensions)
+    _LIST_CACHE[key] = (now, root_mtime, files)
+    return files
+
+def _markdown_sort_key(path):
+    """Part of the filename before the first underscore (the whole name if there is none)."""
+    base = os.path.basename(path)
+    i = base.find('_')
+    return base if i == -1 else base[:i]
+
+def _scan_files(directory, extensions):
+    """Walk a directory tree and return the sorted relative paths for get_files."""
+    files = []
+    # str.endswith takes a tuple and checks every suffix in C
+    exts = tuple(extensions) if extensions else None
+    retention = app.config["HISTORY_RETENTION"]
+
+    # Depth-first walk on os.scandir; DirEntry caches the file type so
+    # classifying entries costs no extra stat() calls.
+    stack = [(directory, "")]
+    while stack:
+        path, rel_root = stack.pop()
+        try:
+            it = os.scandir(path)
+        except OSError:
+            continue
+
+        # Join the relative root once per directory, then concatenate names onto it
+        prefix = rel_root + os.sep if rel_root else ""
+        subdirs = []
         cur_files = []
-        for filename in filenames:
-            if extensions:
-                if not any(filename.endswith(ext) for ext in extensions):
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry)
+                    continue
+                if exts and not entry.name.endswith(exts):
                     continue
-            rel_path = os.path.relpath(os.path.join(root, filename), directory)
-            cur_files.append(rel_path)
+                cur_files.append(prefix + entry.name)
+
+        # Sort directories and keep only the top N (assumed specifically for history retention).
+        # Leaf directories are the common case, so skip the work when there are none.
+        if subdirs:
+            subdirs.sort(key=lambda e: e.name, reverse=True)
+            if retention > 0:
+                del subdirs[retention:]
+            # Push in reverse so the newest directory is visited first
+            for entry in reversed(subdirs):
+                stack.append((entry.path, prefix + entry.name))
             
         # Special sorting for markdown files (business logic)
         # Sort by the part before the first underscore
         if extensions == app.config["MARKDOWN_EXTENSIONS"]:
-             try:
-                 cur_files.sort(key=lambda path: os.path.basename(path).split('_')[0])
-             except IndexError:
-                 # Fallback if filename doesn't have an underscore
-                 cur_files.sort()
+            cur_files.sort(key=_markdown_sort_key)
         else:
             cur_files.sort()
                  
         files.extend(cur_files)
     return files
 
-def get_safe_path(directory_config_key, filename):
+@lru_cache(maxsize=1024)
+def _normalize_filename(filename):
+    """
+    Decode and normalize a filename from the URL.
+    Pure string work, so it is memoized.
+    """
+    # Decode URL-encoded filename
+    decoded_filename = urllib.parse.unquote(filename)
+
+    # Clean filename: remove leading/trailing whitespace and newlines
+    cleaned_filename = decoded_filename.strip().replace("\n", "")
+
+    # Collapse redundant separators and . / .. components
+    return os.path.normpath(cleaned_filename)
+
+def get_safe_path(directory_config_key, filename, check_exists=True):
     """
     Sanitize filename and resolve absolute path.    
     Args:
         directory_config_key (str): The config key for the base directory (e.g., 'UPLOAD_FOLDER').
         filename (str): The potentially unsafe filename/path from URL.        
+        check_exists (bool): Stat the file here; pass False when the caller
+            opens or stats it anyway and handles the missing-file case itself.
     Returns:
         tuple: (absolute_filepath, normalized_filename)
         Raises 404 if file does not exist or path is unsafe.
     """
     directory = app.config[directory_config_key]
-    
-    # Decode URL-encoded filename
-    decoded_filename = urllib.parse.unquote(filename)
-
-    # Clean filename: remove leading/trailing whitespace and newlines
-    cleaned_filename = decoded_filename.strip().replace("\n", "")
+    normalized_filename = _normalize_filename(filename)
 
-    # Normalize path to prevent traversal (e.g. ..)
-    normalized_filename = os.path.normpath(cleaned_filename)
-    
-    # Ensure the path is relative and doesn't escape the directory
-    # (os.path.join handles relative paths correctly, but we must ensure no traversal up)
-    if normalized_filename.startswith("..") or normalized_filename.startswith("/"):
-        logger.warning(f"Attempted path traversal: {normalized_filename}")
+    # safe_join rejects absolute paths and anything escaping the directory
+    filepath = safe_join(directory, normalized_filename)
+    if filepath is None:
+        logger.warning(f"Attempted path traversal: {filename}")
         abort(404)
-
-    filepath = os.path.join(directory, normalized_filename)
     
     # Check if file exists
-    if not os.path.exists(filepath):
+    if check_exists and not os.path.exists(filepath):
         logger.error(f"File not found: {filepath}")
         abort(404)
         
     return filepath, normalized_filename
 
-@app.route("/")
-def index():
+# Index page listings, rebuilt off the request path by a background thread
+_SNAPSHOT = {"media": [], "markdown": []}
+_SNAPSHOT_LOCK = threading.Lock()
+_REFRESHER_LOCK = threading.Lock()
+_refresher = None
+
+def refresh_snapshot():
+    """Rebuild the index page listings."""
     media_files = get_files(app.config["UPLOAD_FOLDER"], extensions=app.config["MEDIA_EXTENSIONS"])
     
     # Fetch both Markdown and Images from the Markdown folder
     mixed_extensions = app.config["MARKDOWN_EXTENSIONS"] + app.config["IMAGE_EXTENSIONS"]
     markdown_files = get_files(app.config["MARKDOWN_FOLDER"], extensions=mixed_extensions)
 
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOT["media"] = media_files
+        _SNAPSHOT["markdown"] = markdown_files
+
+def _refresh_loop():
+    while True:
+        time.sleep(app.config["LISTING_REFRESH_INTERVAL"])
+        try:
+            refresh_snapshot()
+        except Exception:
+            logger.exception("Failed to refresh file listings")
+
+def ensure_refresher():
+    """Build the first snapshot and start the refresh thread, once."""
+    global _refresher
+    if _refresher is not None:
+        return
+    with _REFRESHER_LOCK:
+        if _refresher is None:
+            refresh_snapshot()
+            _refresher = threading.Thread(target=_refresh_loop, name="listing-refresh", daemon=True)
+            _refresher.start()
+
+@app.route("/")
+@compress.compressed()
+def index():
+    ensure_refresher()
+    with _SNAPSHOT_LOCK:
+        media_files = _SNAPSHOT["media"]
+        markdown_files = _SNAPSHOT["markdown"]
+
     return render_template(
         "index.html",
         media_files=media_files,
@@ -117,22 +246,34 @@ def index():
         media_view_route="media_view",
     )
 
+def accel_redirect(prefix, normalized_filename):
+    """Empty response telling nginx to serve the file from an internal location."""
+    response = make_response("")
+    response.headers["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + urllib.parse.quote(normalized_filename)
+    response.mimetype = mimetypes.guess_type(normalized_filename)[0] or "application/octet-stream"
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
+
 @app.route("/media/<path:filename>")
 def media_file(filename):
     """Serve media files with cache control."""
-    # We can rely on send_from_directory for safety, but we'll use our helper 
-    # if we want to strictly validate existence first, or just pass to send_from_directory.
-    # send_from_directory is safe against traversal.
-    # However, to be consistent with other routes that clean the path:
-    
-    # Note: send_from_directory takes the directory and the filename. 
+    # Clean the path the same way as the view routes; send_from_directory
+    # is safe against traversal and returns 404 for missing files itself.
     # If filename contains slashes, it treats it relative to directory.
-    decoded_filename = urllib.parse.unquote(filename)
+    _, normalized_filename = get_safe_path("UPLOAD_FOLDER", filename, check_exists=False)
+
+    if app.config["MEDIA_ACCEL_REDIRECT"]:
+        return accel_redirect(app.config["MEDIA_ACCEL_REDIRECT"], normalized_filename)
     
-    response = send_from_directory(app.config["UPLOAD_FOLDER"], decoded_filename)
-    response.cache_control.public = True
-    response.cache_control.max_age = 300
-    return response
+    # send_file sets the ETag/Last-Modified and answers If-None-Match /
+    # If-Modified-Since with a 304 before any body is read. Passing max_age
+    # here (rather than patching cache_control afterwards) also drops the
+    # no-cache directive it adds by default.
+    return send_from_directory(
+        app.config["UPLOAD_FOLDER"], normalized_filename,
+        conditional=True, etag=True, max_age=300,
+    )
 
 @app.route("/media_view/<path:filename>")
 def media_view(filename):
@@ -149,12 +290,15 @@ def media_view(filename):
 @app.route("/assets/<path:filename>")
 def markdown_asset_file(filename):
     """Serve asset files from the Markdown directory with cache control."""
-    decoded_filename = urllib.parse.unquote(filename)
+    _, normalized_filename = get_safe_path("MARKDOWN_FOLDER", filename, check_exists=False)
+
+    if app.config["ASSETS_ACCEL_REDIRECT"]:
+        return accel_redirect(app.config["ASSETS_ACCEL_REDIRECT"], normalized_filename)
     
-    response = send_from_directory(app.config["MARKDOWN_FOLDER"], decoded_filename)
-    response.cache_control.public = True
-    response.cache_control.max_age = 300
-    return response
+    return send_from_directory(
+        app.config["MARKDOWN_FOLDER"], normalized_filename,
+        conditional=True, etag=True, max_age=300,
+    )
 
 @app.route("/assets_view/<path:filename>")
 def markdown_asset_view(filename):
@@ -169,25 +313,38 @@ def markdown_asset_view(filename):
         "media.html", filename=normalized_filename, file_url=file_url
     )
 
+# Markdown pre-processing patterns, compiled once at import
+_LIST_ITEM_RE = re.compile(r'^(\s*([*+-]|\d+\.)\s+)')
+# The newline in front of a list item line; [^\S\n] is same-line whitespace
+_LIST_START_RE = re.compile(r'\n(?=[^\S\n]*(?:[*+-]|\d+\.)[^\S\n])')
+# The lookahead keeps a math placeholder nested in bracket math intact
+_SUBSCRIPT_RE = re.compile(r'_([a-zA-Z0-9]+)')
+_BRACKET_MATH_RE = re.compile(r'\[\s*(.*?)\s*\]', re.DOTALL)
+# Any placeholder as built by process_math_pre_markdown, whatever its salt
+_PLACEHOLDER_RE = re.compile(r'MATH\d*\.\d+\.PH')
+
 def fix_list_spacing(markdown_content: str) -> str:
     """
     Ensure there is a blank line before list items if preceded by a non-blank line.
     This helps the markdown parser correctly identify lists even when they are 
     immediately preceded by text (common with nl2br extension).
     """
-    # Match lines starting with bullet (*, -, +) or numbered list (1.) followed by space
-    list_item_pattern = re.compile(r'^(\s*([*+-]|\d+\.)\s+)')
-    
-    lines = markdown_content.split('\n')
-    new_lines = []
-    for i, line in enumerate(lines):
-        if i > 0 and list_item_pattern.match(line):
-            prev_line = lines[i-1].strip()
-            # If previous line is not empty and doesn't look like a list item itself
-            if prev_line and not list_item_pattern.match(lines[i-1]):
-                new_lines.append('')
-        new_lines.append(line)
-    return '\n'.join(new_lines)
+    # Let the regex engine find the list items and only look at the lines
+    # in front of them, instead of matching every line in Python
+    parts = []
+    pos = 0
+    for match in _LIST_START_RE.finditer(markdown_content):
+        end = match.start()
+        prev_line = markdown_content[markdown_content.rfind('\n', 0, end) + 1:end]
+        # If previous line is not empty and doesn't look like a list item itself
+        if prev_line.strip() and not _LIST_ITEM_RE.match(prev_line):
+            parts.append(markdown_content[pos:end])
+            parts.append('\n')
+            pos = end
+    if not parts:
+        return markdown_content
+    parts.append(markdown_content[pos:])
+    return ''.join(parts)
 
 def fix_math_content(content):
     """
@@ -198,7 +355,35 @@ def fix_math_content(content):
       This turns x_i_j into x_{i}_{j} which MathJax handles correctly.
     """
     content = content.replace('\n', ' ')
-    return re.sub(r'_([a-zA-Z0-9]+)', r'_{\1}', content)
+    return brace_subscripts(content)
+
+def brace_subscripts(content):
+    """Brace single alphanumeric subscripts: _x -> _{x}."""
+    if '_' not in content:
+        return content
+    return _SUBSCRIPT_RE.sub(r'_{\1}', content)
+
+def replace_delimited(text, delimiter, replace):
+    """
+    Replace each delimiter...delimiter span in text with replace(content).
+    Same result as a non-greedy DOTALL regex substitution, but scans with
+    str.find so it stays linear and never backtracks.
+    """
+    width = len(delimiter)
+    parts = []
+    pos = 0
+    while True:
+        start = text.find(delimiter, pos)
+        if start < 0:
+            break
+        end = text.find(delimiter, start + width)
+        if end < 0:
+            break
+        parts.append(text[pos:start])
+        parts.append(replace(text[start + width:end]))
+        pos = end + width
+    parts.append(text[pos:])
+    return ''.join(parts)
 
 def process_math_pre_markdown(text):
     """
@@ -206,13 +391,41 @@ def process_math_pre_markdown(text):
     Returns: (text_with_placeholders, placeholders_dict)
     """
     placeholders = {}
+    # Most documents have no math; `in` is a C-level scan, far cheaper than the passes below
+    has_dollar = '$' in text
+    if not has_dollar and '[' not in text:
+        return text, placeholders
     
+    # Subscripts are braced for all spans at the end in one pass, unless a
+    # NUL in the source would clash with the join separator
+    batch_subscripts = '\x00' not in text
+
+    # Placeholders are plain ASCII so they survive both engines untouched,
+    # including inside link and image URLs where cmark percent-encodes
+    # anything else; word characters at both ends keep emphasis next to math
+    # parsing as it did with the old alphanumeric keys, and '.' is not one of
+    # the bracket-math heuristic characters. Salt the prefix until it does not
+    # occur in the source, so document text can never forge a key.
+    prefix = "MATH"
+    salt = 0
+    while prefix + "." in text:
+        prefix = f"MATH{salt}"
+        salt += 1
+
     def store_math(content, is_display, delimiter_type='dollar'):
+        # Inline any earlier span this one encloses (e.g. $...$ inside
+        # bracket math) so stored values never contain keys
+        if prefix + "." in content:
+            content = _PLACEHOLDER_RE.sub(lambda m: placeholders.get(m.group(0), m.group(0)), content)
+
         # Apply fixes (remove newlines, fix subscripts)
-        fixed_content = fix_math_content(content)
+        if batch_subscripts:
+            fixed_content = content.replace('\n', ' ')
+        else:
+            fixed_content = fix_math_content(content)
         
-        # Create unique placeholder
-        key = f"MATHPLACEHOLDER{uuid.uuid4().hex}ENDMATHPLACEHOLDER"
+        # Placeholders only need to be unique within the document, so number them
+        key = f"{prefix}.{len(placeholders)}.PH"
         
         # Wrap in appropriate delimiters for final output
         if delimiter_type == 'bracket':
@@ -225,20 +438,16 @@ def process_math_pre_markdown(text):
         placeholders[key] = final_math
         return key
 
-    # 1. Handle $$ ... $$ -> Display Math
-    # (Processed first to avoid conflict with inline math or brackets)
-    text = re.sub(r'\$\$(.*?)\$\$', 
-                  lambda m: store_math(m.group(1), True, delimiter_type='dollar'), 
-                  text, flags=re.DOTALL)
+    if has_dollar:
+        # 1. Handle $$ ... $$ -> Display Math
+        # (Processed first to avoid conflict with inline math or brackets)
+        text = replace_delimited(text, '$$', lambda content: store_math(content, True, delimiter_type='dollar'))
 
-    # 2. Handle $ ... $ -> Inline Math
-    text = re.sub(r'\$(.*?)\$', 
-                  lambda m: store_math(m.group(1), False, delimiter_type='dollar'), 
-                  text, flags=re.DOTALL)
+        # 2. Handle $ ... $ -> Inline Math
+        text = replace_delimited(text, '$', lambda content: store_math(content, False, delimiter_type='dollar'))
 
     # 3. Handle [ ... ] with heuristic -> Display Math (\[ ... \])
     # (Processed last as a fallback/heuristic)
-    bracket_pattern = r'\[\s*(.*?)\s*\]'
     def replace_bracket_math(match):
         math_content = match.group(1).strip()
         # Heuristic to distinguish math from markdown links/text
@@ -247,47 +456,162 @@ def process_math_pre_markdown(text):
         else:
             return match.group(0)
     
-    text = re.sub(bracket_pattern, replace_bracket_math, text, flags=re.DOTALL)
+    if '[' in text:
+        text = _BRACKET_MATH_RE.sub(replace_bracket_math, text)
+
+    # 4. Fix subscripts across every stored span with a single regex call
+    if batch_subscripts and placeholders:
+        fixed = brace_subscripts('\x00'.join(placeholders.values())).split('\x00')
+        placeholders = dict(zip(placeholders, fixed))
                   
     return text, placeholders
 
 def restore_math(html, placeholders):
-    """Restore math content from placeholders."""
-    for key, val in placeholders.items():
-        html = html.replace(key, val)
-    return html
+    """Restore math content from placeholders in a single pass over the HTML."""
+    if not placeholders:
+        return html
+    # Stored values never contain keys, and look-alikes from the document
+    # text are not in the dict, so they are left as they are
+    return _PLACEHOLDER_RE.sub(lambda m: placeholders.get(m.group(0), m.group(0)), html)
 
-@app.route("/markdown/<path:filename>")
-def render_markdown(filename):
-    """Render Markdown file with MathJax support."""
-    filepath, _ = get_safe_path("MARKDOWN_FOLDER", filename)
+# Extensions are instantiated once; building a Markdown instance registers
+# every extension, so that is also done once and reset() between documents.
+_MD_EXTENSIONS = [
+    ExtraExtension(),
+    'markdown.extensions.nl2br',
+    'markdown.extensions.tables'
+]
+_MD = markdown.Markdown(extensions=_MD_EXTENSIONS)
+_MD_LOCK = threading.Lock()
 
-    with open(filepath, "r", encoding="utf-8") as f:
-        md_content = f.read()
+# HARDBREAKS matches nl2br, FOOTNOTES covers the common Extra feature.
+# UNSAFE alone does not pass raw HTML through: GFM's tagfilter extension
+# would still escape <iframe>, <style> and friends, so it is left out of
+# _CMARK_EXTENSIONS to keep raw HTML rendering like Python-Markdown.
+_CMARK_OPTIONS = (
+    CmarkOptions.CMARK_OPT_HARDBREAKS
+    | CmarkOptions.CMARK_OPT_UNSAFE
+    | CmarkOptions.CMARK_OPT_FOOTNOTES
+)
+_CMARK_EXTENSIONS = ["table", "autolink", "strikethrough", "tasklist"]
+
+_render_pool = None
+_RENDER_POOL_LOCK = threading.Lock()
+
+def _python_markdown(text):
+    """Convert with the shared Python-Markdown instance; also runs in pool workers."""
+    # The shared parser keeps per-document state, so renders are serialized
+    with _MD_LOCK:
+        return _MD.reset().convert(text)
+
+def get_render_pool():
+    """Create the Markdown render process pool on first use."""
+    global _render_pool
+    if _render_pool is None:
+        with _RENDER_POOL_LOCK:
+            if _render_pool is None:
+                # spawn, not fork: forking a threaded server can copy held locks into the child
+                _render_pool = ProcessPoolExecutor(
+                    max_workers=app.config["MARKDOWN_RENDER_PROCESSES"],
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _render_pool
+
+def convert_markdown(text, engine=None):
+    """Convert Markdown text to HTML with engine, defaulting to MARKDOWN_ENGINE."""
+    global _render_pool
+    if (engine or app.config["MARKDOWN_ENGINE"]) == "cmark":
+        return cmarkgfm.markdown_to_html_with_extensions(
+            text, options=_CMARK_OPTIONS, extensions=_CMARK_EXTENSIONS
+        )
+
+    if app.config["MARKDOWN_RENDER_PROCESSES"] > 0:
+        pool = get_render_pool()
+        try:
+            return pool.submit(_python_markdown, text).result()
+        except BrokenProcessPool:
+            # A dead worker breaks the whole pool; drop it so the next
+            # request starts a fresh one, and render this one in-process
+            logger.exception("Markdown render pool broke, recreating it")
+            with _RENDER_POOL_LOCK:
+                if _render_pool is pool:
+                    _render_pool = None
+            pool.shutdown(wait=False)
+    return _python_markdown(text)
+
+@lru_cache(maxsize=256)
+def _render_cached(filepath, mtime_ns, size, engine):
+    """
+    Render a Markdown file to HTML.
+    The mtime, size and engine are part of the cache key, so an edited
+    file or a MARKDOWN_ENGINE change misses the cache and is re-rendered.
+    """
+    # A single binary read + decode is cheaper than the text IO layer
+    with open(filepath, "rb") as f:
+        md_content = f.read().decode("utf-8")
+    # Keep the universal-newline behaviour of text mode
+    if "\r" in md_content:
+        md_content = md_content.replace("\r\n", "\n").replace("\r", "\n")
 
     md_content = fix_list_spacing(md_content)
     
     # Pre-process math to protect it from Markdown
     final_md_content, math_placeholders = process_math_pre_markdown(md_content)
 
-    extensions = [
-        ExtraExtension(),
-        'markdown.extensions.nl2br',
-        'markdown.extensions.tables'
-    ]
-
-    md = markdown.Markdown(extensions=extensions)
-    html_content = md.convert(final_md_content)
+    html_content = convert_markdown(final_md_content, engine)
     
     # Restore math content
-    html_content = restore_math(html_content, math_placeholders)
+    return restore_math(html_content, math_placeholders)
 
-    return render_template(
-        "markdown.html", 
-        content=html_content,
-        filename=filename # Passing original filename for title/display
-    )
+# Rendered pages depend on this module and the page template as well as the
+# Markdown file, so fold their mtimes into the ETag: a deploy or template
+# edit then invalidates cached pages instead of answering 304 with old HTML.
+_RENDER_VERSION = "%08x" % zlib.crc32(" ".join(
+    str(os.stat(path).st_mtime_ns)
+    for path in (__file__, os.path.join(app.root_path, app.template_folder, "markdown.html"))
+).encode())
+
+@app.route("/markdown/<path:filename>")
+@compress.compressed()
+def render_markdown(filename):
+    """Render Markdown file with MathJax support."""
+    filepath, _ = get_safe_path("MARKDOWN_FOLDER", filename, check_exists=False)
+
+    # One stat() both checks existence and keys the caches
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        logger.error(f"File not found: {filepath}")
+        abort(404)
+
+    # Answer conditional GETs before touching the render pipeline. The engine
+    # and _RENDER_VERSION are part of the validator because they change the
+    # generated HTML.
+    engine = app.config["MARKDOWN_ENGINE"]
+    etag = f"{st.st_mtime_ns:x}-{st.st_size:x}-{engine}-{_RENDER_VERSION}"
+    if request.if_none_match.contains_weak(etag):
+        # A 304 carries the same validators and caching headers as the 200
+        response = make_response("", 304)
+    else:
+        try:
+            html_content = _render_cached(filepath, st.st_mtime_ns, st.st_size, engine)
+        except FileNotFoundError:
+            # Removed between the stat() and the open()
+            logger.error(f"File not found: {filepath}")
+            abort(404)
+
+        response = make_response(render_template(
+            "markdown.html", 
+            content=html_content,
+            filename=filename # Passing original filename for title/display
+        ))
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
 
 if __name__ == "__main__":
-    # In production, use a WSGI server (e.g., gunicorn)
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    # Development server only; in production run a WSGI server, e.g.
+    #   gunicorn -w $(nproc) -k gthread --threads 4 app:app
+    # The debugger and reloader are opt-in via FLASK_DEBUG=1.
+    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file